@@ -1,4 +1,13 @@
+import concurrent.futures as cf
+import fnmatch
+import functools
+import inspect
+import json
+import math
+import os
 import pathlib
+import shlex
+import shutil
 
 import invoke
 
@@ -8,209 +17,341 @@ DOCKER_IMAGE = "ghcr.io/kevin-mckenzie/n-proxy:latest"
 PROJECT_NAME = "nacl-proxy"
 VERSION = "1.0.0"
 
+# Compile jobs per CMake build; *_all tasks run cpu_count // BUILD_JOBS targets at once.
+BUILD_JOBS = 4
+
 TOOLCHAIN_INSTALL_DIR = "/opt/cross"
+TOOLCHAIN_CACHE_DIR = pathlib.Path.home() / ".cache" / PROJECT_NAME / "toolchains"
 BOOTLIN_CMAKE_TOOLCHAIN_POSTFIX = "share/buildroot/toolchainfile.cmake"
 
-TARGETS = {
-    "local": {
-        "test": True,
-    },
-    "asan": {
-        "test": True,
-        "linking": "dynamic",
-    },
-    "valgrind": {
-        "test": True,
-        "emulator": "valgrind --leak-check=full --show-leak-kinds=all --exit-on-first-error=yes --error-exitcode=1 --errors-for-leak-kinds=all",
-        "linking": "dynamic",
-    },
-    "linux-x86_64-musl": {
-        "url": "https://toolchains.bootlin.com/downloads/releases/toolchains/x86-64/tarballs/x86-64--musl--stable-2024.05-1.tar.xz",
-        "toolchain_file": f"{TOOLCHAIN_INSTALL_DIR}/x86-64--musl--stable-2024.05-1/{BOOTLIN_CMAKE_TOOLCHAIN_POSTFIX}",
-        "test": True,
-    },
-    "linux-i686-musl": {
-        "url": "https://toolchains.bootlin.com/downloads/releases/toolchains/x86-i686/tarballs/x86-i686--musl--stable-2025.08-1.tar.xz",
-        "toolchain_file": f"{TOOLCHAIN_INSTALL_DIR}/x86-i686--musl--stable-2025.08-1/{BOOTLIN_CMAKE_TOOLCHAIN_POSTFIX}",
-        "emulator": "qemu-i386-static",
-        "test": True,
-    },
-    "linux-arm64-musl": {
-        "url": "https://toolchains.bootlin.com/downloads/releases/toolchains/aarch64/tarballs/aarch64--musl--stable-2025.08-1.tar.xz",
-        "toolchain_file": f"{TOOLCHAIN_INSTALL_DIR}/aarch64--musl--stable-2025.08-1/{BOOTLIN_CMAKE_TOOLCHAIN_POSTFIX}",
-        "emulator": "qemu-aarch64-static",
-        "test": True,
-    },
-    "linux-arm-musl": {
-        "url": "https://toolchains.bootlin.com/downloads/releases/toolchains/armv7-eabihf/tarballs/armv7-eabihf--musl--stable-2025.08-1.tar.xz",
-        "toolchain_file": f"{TOOLCHAIN_INSTALL_DIR}/armv7-eabihf--musl--stable-2025.08-1/{BOOTLIN_CMAKE_TOOLCHAIN_POSTFIX}",
-        "emulator": "qemu-arm-static",
-        "test": True,
-    },
-    "linux-mips-musl": {
-        "url": "https://toolchains.bootlin.com/downloads/releases/toolchains/mips32/tarballs/mips32--musl--stable-2025.08-1.tar.xz",
-        "toolchain_file": f"{TOOLCHAIN_INSTALL_DIR}/mips32--musl--stable-2025.08-1/{BOOTLIN_CMAKE_TOOLCHAIN_POSTFIX}",
-        "emulator": "qemu-mips-static",
-        "test": True,
-    },
-}
-
-
-def filenames_string(*patterns) -> str:
+
+@functools.cache
+def targets() -> dict:
+    """Build targets from targets.json, read once per process.
+
+    Targets with a Bootlin toolchain url get a toolchain_file inside the extracted tarball.
+    """
+    with open(pathlib.Path(__file__).with_name("targets.json"), encoding="utf-8") as f:
+        confs = json.load(f)
+    for conf in confs.values():
+        if "url" in conf:
+            toolchain = conf["url"].split("/")[-1].removesuffix(".tar.xz")
+            conf["toolchain_file"] = (
+                f"{TOOLCHAIN_INSTALL_DIR}/{toolchain}/{BOOTLIN_CMAKE_TOOLCHAIN_POSTFIX}"
+            )
+    return confs
+
+
+def require_target(fn):
+    """Validate the target argument and pass its targets.json entry to fn as cfg.
+
+    cfg is hidden from the task's signature so invoke does not expose it as a CLI flag.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(ctx, *args, target: str = "local", **kwargs):
+        if target not in targets():
+            raise invoke.Exit(
+                f"Invalid target: {target} must be one of {list(targets().keys())}"
+            )
+        return fn(ctx, *args, target=target, cfg=targets()[target], **kwargs)
+
+    sig = inspect.signature(fn)
+    wrapper.__signature__ = sig.replace(
+        parameters=[p for p in sig.parameters.values() if p.name != "cfg"]
+    )
+    return wrapper
+
+
+# Hidden directories cover .git and .venv; virtualenvs under any other name are found by their pyvenv.cfg.
+SKIP_DIRS = (".*", "dist", "build-*")
+
+
+def _skip_dir(entry: os.DirEntry) -> bool:
+    return any(fnmatch.fnmatch(entry.name, d) for d in SKIP_DIRS) or os.path.isfile(
+        os.path.join(entry.path, "pyvenv.cfg")
+    )
+
+
+def filenames_string(root: str, *patterns) -> str:
+    """Space separated paths of files under root whose names match any of patterns."""
     files = []
-    for pattern in patterns:
-        files += [f.as_posix() for f in pathlib.Path(".").rglob(pattern) if f.is_file()]
-    return " ".join(files)
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if not _skip_dir(entry):
+                        stack.append(entry.path)
+                elif any(fnmatch.fnmatch(entry.name, p) for p in patterns):
+                    files.append(os.path.relpath(entry.path))
+    return " ".join(sorted(files))
+
+
+@functools.cache
+def c_files() -> str:
+    return filenames_string("src", "*.c", "*.h")
+
+
+@functools.cache
+def cmake_files() -> str:
+    return filenames_string(".", "*.cmake", "CMakeLists.txt")
 
 
-C_FILES = filenames_string("src/**/*.c", "src/**/*.h")
-CMAKE_FILES = filenames_string("cmake/*.cmake", "CMakeLists.txt")
+def batched(cmd: str, files: str) -> str:
+    """Shell pipeline running cmd over files split into one batch per CPU, all in parallel."""
+    per_process = max(1, math.ceil(len(files.split()) / (os.cpu_count() or 1)))
+    return f'printf "%s\\n" {files} | xargs -P 0 -n {per_process} {cmd}'
 
 
 @invoke.task
 def format(ctx):  # pylint: disable=W0622
     """Format source code using ruff, clang-format, and cmake-format."""
     ctx.run("ruff format")
-    ctx.run(f"clang-format -i {C_FILES}")
-    ctx.run(f"cmake-format -i {CMAKE_FILES}")
+    ctx.run(batched("clang-format -i", c_files()))
+    ctx.run(batched("cmake-format -i", cmake_files()))
 
 
 @invoke.task
 def lint(ctx):
     """Lint source code using lizard, clang-format, and cmake-format."""
-    ctx.run(f"lizard -w -C 12 -L 60 {C_FILES}")
-    ctx.run(f"clang-format -i --dry-run -Werror {C_FILES}")
-    ctx.run(f"cmake-format --check -l debug {CMAKE_FILES}")
+    ctx.run(f"lizard -t {os.cpu_count() or 1} -w -C 12 -L 60 {c_files()}")
+    ctx.run(batched("clang-format -i --dry-run -Werror", c_files()))
+    ctx.run(batched("cmake-format --check -l debug", cmake_files()))
 
 
 @invoke.task
+@require_target
 def analyze(
     ctx: invoke.context,
     target: str = "local",
     release: bool = False,
+    cfg: dict | None = None,
 ):
     """Perform static analysis using CodeChecker on an already built target. See `inv build --list-targets` for valid targets."""
-    if target not in TARGETS:
-        raise invoke.Exit(
-            f"Invalid target: {target} must be one of {list(TARGETS.keys())}"
-        )
-    linking = TARGETS[target].get("linking", "static")
+    linking = cfg.get("linking", "static")
     build_type = "MinSizeRel" if release else "Debug"
-    build_name = f"{target}-{linking}-{build_type.lower()}"
-    build_dir = f"build-{build_name}"
+    build_dir = f"build-{target}-{linking}"
+    report_dir = f"build-{target}-{linking}-{build_type.lower()}"
+
+    # The multi-config compilation database lists every configuration; analyze one of them.
+    compile_commands = pathlib.Path(build_dir, build_type, "compile_commands.json")
+    compile_commands.parent.mkdir(exist_ok=True)
+    entries = json.loads(pathlib.Path(build_dir, "compile_commands.json").read_text())
+    compile_commands.write_text(
+        json.dumps([e for e in entries if f"/{build_type}/" in e["output"]], indent=2)
+    )
 
-    ctx.run(f"mkdir -p dist/reports/analysis/{build_dir}")
+    ctx.run(f"mkdir -p dist/reports/analysis/{report_dir}")
     ctx.run(
-        f"CodeChecker analyze {build_dir}/compile_commands.json \
+        f"CodeChecker analyze {compile_commands} \
                 --skip .skip \
                 --analyzers cppcheck gcc clangsa clang-tidy \
                 --enable-all \
                 --analyzer-config clang-tidy:take-config-from-directory=true \
                 --analyzer-config cppcheck:cc-verbatim-args-file=.cppcheck \
                 --disable security.insecureAPI.DeprecatedOrUnsafeBufferHandling \
-                -o dist/reports/analysis/{build_dir}/out"
+                -o dist/reports/analysis/{report_dir}/out"
     )
     ctx.run(
-        f"CodeChecker parse dist/reports/analysis/{build_dir}/out -o dist/reports/analysis/{build_dir}/report -e html"
+        f"CodeChecker parse dist/reports/analysis/{report_dir}/out -o dist/reports/analysis/{report_dir}/report -e html"
     )
-    ctx.run(f"rm -fdr dist/reports/analysis/{build_dir}/out")
+    ctx.run(f"rm -fdr dist/reports/analysis/{report_dir}/out")
+
+
+def _cache_matches(build_dir: str, defines: dict) -> bool:
+    """True if build_dir was configured with defines and no CMake file changed since.
+
+    A failed configure still writes CMakeCache.txt, so build.ninja, which is only written once
+    generation succeeds, must exist too.
+    """
+    cache = pathlib.Path(build_dir, "CMakeCache.txt")
+    if not cache.is_file() or not pathlib.Path(build_dir, "build.ninja").is_file():
+        return False
+
+    cache_mtime = cache.stat().st_mtime
+    if any(os.stat(f).st_mtime > cache_mtime for f in cmake_files().split()):
+        return False
+
+    cached = {}
+    for line in cache.read_text().splitlines():
+        if line and not line.startswith(("#", "//")) and ":" in line and "=" in line:
+            key, _, value = line.partition("=")
+            cached[key.split(":", 1)[0]] = value
+
+    return all(cached.get(key) == value for key, value in defines.items())
 
 
 @invoke.task
+@require_target
 def build(
     ctx: invoke.context,
     target: str = "local",
     release: bool = False,
     list_targets: bool = False,
+    cfg: dict | None = None,
 ):
     """Build the project using CMake. See inv build --list-targets for valid targets."""
-    if target not in TARGETS:
-        raise invoke.Exit(
-            f"Invalid target: {target} must be one of {list(TARGETS.keys())}"
-        )
 
     if list_targets:
-        print(f"Available targets: {list(TARGETS.keys())}")
+        print(f"Available targets: {list(targets().keys())}")
         return
 
-    linking = TARGETS[target].get("linking", "static")
+    linking = cfg.get("linking", "static")
     build_type = "MinSizeRel" if release else "Debug"
-    build_name = f"{target}-{linking}-{build_type.lower()}"
+    build_name = f"{target}-{linking}"
     build_dir = f"build-{build_name}"
 
-    cmake_defines = (
-        f"-DLINKING={linking} "
-        f"-DBUILD_NAME={build_name} "
-        f"-DCMAKE_BUILD_TYPE={build_type} "
-        "-G Ninja "
-    )
+    # Debug and MinSizeRel share one Ninja Multi-Config build directory per target.
+    defines = {
+        "LINKING": linking,
+        "BUILD_NAME": build_name,
+        "CMAKE_CONFIGURATION_TYPES": "Debug;MinSizeRel",
+    }
 
     if "asan" == target:
-        cmake_defines += "-DASAN=ON"
+        defines["ASAN"] = "ON"
 
-    if "toolchain_file" in TARGETS[target]:
-        cmake_defines += f"-DCMAKE_TOOLCHAIN_FILE={TARGETS[target]['toolchain_file']} "
+    if "toolchain_file" in cfg:
+        defines["CMAKE_TOOLCHAIN_FILE"] = cfg["toolchain_file"]
 
     if linking != "static":
-        cmake_defines += "-DBUILD_SHARED_LIBS=ON"
-
-    ctx.run(f"cmake {cmake_defines} -S . -B {build_dir}")
-    ctx.run(f"cmake --build {build_dir} --target install")
+        defines["BUILD_SHARED_LIBS"] = "ON"
+
+    # Always defined, even when empty, so adding or removing ccache forces a reconfigure.
+    defines["CMAKE_C_COMPILER_LAUNCHER"] = ""
+    env = {}
+    if shutil.which("ccache"):
+        # Paths relative to the project root and compiler hashes by content keep cache hits
+        # shared across every build-* directory.
+        defines["CMAKE_C_COMPILER_LAUNCHER"] = "ccache"
+        env = {"CCACHE_BASEDIR": os.getcwd(), "CCACHE_COMPILERCHECK": "content"}
+
+    if not _cache_matches(build_dir, defines):
+        cmake_defines = " ".join(
+            f"-D{key}={shlex.quote(value)}" for key, value in defines.items()
+        )
+        ctx.run(
+            f'cmake {cmake_defines} -G "Ninja Multi-Config" -S . -B {build_dir}',
+            env=env,
+        )
+    ctx.run(
+        f"cmake --build {build_dir} --config {build_type} --target install", env=env
+    )
 
 
 @invoke.task
+@require_target
 def test(
     ctx: invoke.context,
     target: str = "local",
     k: str = "",
     release: bool = False,
+    xdist: bool = True,
+    cfg: dict | None = None,
 ):
-    """Run tests using pytest on an already built target. See inv build --list-targets for valid targets."""
-    if target not in TARGETS:
-        raise invoke.Exit(
-            f"Invalid target: {target} must be one of {list(TARGETS.keys())}"
-        )
+    """Run tests using pytest on an already built target. See inv build --list-targets for valid targets.
 
-    linking = TARGETS[target].get("linking", "static")
+    Tests are spread across pytest-xdist workers, one proxy chain per worker, unless --no-xdist is given or the
+    target is slow (valgrind).
+    """
+    linking = cfg.get("linking", "static")
     build_type = "MinSizeRel" if release else "Debug"
     build_name = f"{target}-{linking}-{build_type.lower()}"
 
-    bin_path = pathlib.Path(f"./dist/bin/proxy-{build_name}").absolute().as_posix()
-    emulator = TARGETS[target].get("emulator", "")
+    env = {
+        "PYTHONPATH": "test",
+        "EMULATOR": cfg.get("emulator", ""),
+        "BIN_PATH": os.path.abspath(f"dist/bin/proxy-{build_name}"),
+    }
 
-    ctx.run(
-        f'PYTHON_PATH=test EMULATOR="{emulator}" BIN_PATH="{bin_path}" pytest . -k={k} -vv'
-    )
+    pytest_args = f"-k={shlex.quote(k)} -vv"
+    if xdist and not cfg.get("slow", False):
+        pytest_args += " -n auto --dist=loadgroup"
+
+    ctx.run(f"pytest . {pytest_args}", env=env)
 
 
 @invoke.task
 def package(ctx: invoke.context):
-    """Package built binaries and documentation into tarballs and zip files."""
-    ctx.run(f"tar -czf dist/{PROJECT_NAME}_{VERSION}_pkg.tar.gz dist/bin")
-    ctx.run(f"zip -r dist/{PROJECT_NAME}_{VERSION}_docs.zip dist/docs")
+    """Package built binaries and documentation into tarballs and zip files.
+
+    Uses multithreaded zstd (.tar.zst) or pigz when installed, falling back to gzip.
+    """
+    pkg = f"dist/{PROJECT_NAME}_{VERSION}_pkg"
+    if shutil.which("zstd"):
+        ctx.run(f"tar --use-compress-program='zstd -T0 -19' -cf {pkg}.tar.zst dist/bin")
+    elif shutil.which("pigz"):
+        ctx.run(f"tar --use-compress-program=pigz -cf {pkg}.tar.gz dist/bin")
+    else:
+        ctx.run(f"tar -czf {pkg}.tar.gz dist/bin")
+
+    docs = f"dist/{PROJECT_NAME}_{VERSION}_docs.zip"
+    if shutil.which("7z"):
+        ctx.run(f"7z a -tzip -mmt=on {docs} dist/docs")
+    else:
+        ctx.run(f"zip -r {docs} dist/docs")
+
+
+def _build_one(target: str):
+    # Both build types share a build directory, so they are built by the same worker.
+    os.environ.setdefault("CMAKE_BUILD_PARALLEL_LEVEL", str(BUILD_JOBS))
+    build(invoke.Context(), target=target, release=False)
+    build(invoke.Context(), target=target, release=True)
+
+
+def _analyze_one(target: str, release: bool):
+    analyze(invoke.Context(), target=target, release=release)
+
+
+def _test_one(target: str, release: bool):
+    # Targets already run side by side in the pool; xdist on top would start a worker per CPU each.
+    test(invoke.Context(), target=target, release=release, xdist=False)
+
+
+def run_parallel(fn, jobs: list[tuple]):
+    """Run fn(*job) for each job in a process pool, re-raising the first failure.
+
+    Jobs still queued when one fails are cancelled rather than run to completion.
+    """
+    workers = max(1, min(len(jobs), (os.cpu_count() or 1) // BUILD_JOBS))
+    with cf.ProcessPoolExecutor(max_workers=workers) as ex:
+        try:
+            for future in [ex.submit(fn, *job) for job in jobs]:
+                future.result()
+        except BaseException:
+            ex.shutdown(cancel_futures=True)
+            raise
 
 
 @invoke.task
-def build_all(ctx):
-    """Build all targets defined in the TARGETS dictionary."""
-    for target in TARGETS:
-        build(ctx, target=target, release=False)
-        build(ctx, target=target, release=True)
+def build_all(ctx):  # pylint: disable=W0613
+    """Build all targets defined in targets.json."""
+    run_parallel(_build_one, [(t,) for t in targets()])
 
 
 @invoke.task
-def analyze_all(ctx):
-    """Analyze all targets defined in the TARGETS dictionary."""
-    for target in TARGETS:
-        analyze(ctx, target=target, release=False)
-        analyze(ctx, target=target, release=True)
+def analyze_all(ctx):  # pylint: disable=W0613
+    """Analyze all targets defined in targets.json."""
+    run_parallel(_analyze_one, [(t, r) for t in targets() for r in (False, True)])
 
 
 @invoke.task
-def test_all(ctx):
-    """Test all targets defined in the TARGETS dictionary that have 'test' set to True."""
-    for target, keys in TARGETS.items():
-        if keys.get("test", False):
+def test_all(ctx):  # pylint: disable=W0613
+    """Test all targets defined in targets.json that have 'test' set to True, except slow ones (see test-slow)."""
+    tested = [
+        t
+        for t, keys in targets().items()
+        if keys.get("test", False) and not keys.get("slow", False)
+    ]
+    run_parallel(_test_one, [(t, r) for t in tested for r in (False, True)])
+
+
+@invoke.task
+def test_slow(ctx):
+    """Test the targets defined in targets.json that have 'slow' set to True (valgrind), one at a time."""
+    for target, keys in targets().items():
+        if keys.get("test", False) and keys.get("slow", False):
             test(ctx, target=target, release=False)
             test(ctx, target=target, release=True)
 
@@ -239,14 +380,27 @@ def docker(ctx: invoke.context, build: bool = False, push: bool = False):  # pyl
 
 @invoke.task
 def install_toolchains(ctx, target="all"):
-    """Download and install cross-compilation toolchains from Bootlin."""
-    install_targets = TARGETS
-    if target != "all":
-        install_targets[target] = TARGETS[target]
+    """Download and install cross-compilation toolchains from Bootlin. Downloads are cached in ~/.cache/nacl-proxy/toolchains."""
+    if target != "all" and target not in targets():
+        raise invoke.Exit(
+            f"Invalid target: {target} must be one of {list(targets().keys())}"
+        )
+    install_targets = targets() if target == "all" else {target: targets()[target]}
 
-    for conf in install_targets.values():
-        if "url" in conf:
-            tarball_name = conf["url"].split("/")[-1]
-            ctx.run(f"curl -O {conf['url']}")
-            ctx.run(f"tar -xf {tarball_name} -C {TOOLCHAIN_INSTALL_DIR}")
-            ctx.run(f"rm {tarball_name}")
+    urls = [conf["url"] for conf in install_targets.values() if "url" in conf]
+
+    TOOLCHAIN_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    def install(url: str):
+        # Tarballs are kept by name so later installs skip the download. Downloading to .part
+        # first keeps an interrupted transfer out of the cache.
+        tarball = TOOLCHAIN_CACHE_DIR / url.split("/")[-1]
+        if not tarball.exists():
+            ctx.run(
+                f"curl -fsSL -o {tarball}.part {url} && mv {tarball}.part {tarball}"
+            )
+        ctx.run(f"tar -xf {tarball} -C {TOOLCHAIN_INSTALL_DIR}")
+
+    with cf.ThreadPoolExecutor(max_workers=max(1, len(urls))) as ex:
+        for future in [ex.submit(install, url) for url in urls]:
+            future.result()
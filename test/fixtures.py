@@ -1,13 +1,36 @@
+import concurrent.futures as cf
 import dataclasses
+import functools
 import time
 import subprocess
+import sys
 import os
 import socket
 
 import pytest
+import requests
+from requests.adapters import HTTPAdapter
 
 # pylint: disable=C0116
 
+# Proxy chain fixtures tests parametrize proxy_configuration over.
+PROXY_CONFIGS = [
+    "single_proxy_unencrypted_ms",
+    "double_proxy_unencrypted_ms",
+    "triple_proxy_unencrypted_ms",
+    "double_proxy_encrypted_ms",
+    "triple_proxy_encrypted_ms",
+    "quad_proxy_encrypted_ms",
+]
+
+# Runs a test once per proxy chain in PROXY_CONFIGS. Each chain is its own xdist group, so with
+# --dist=loadgroup all tests for a chain share one worker and the chains run side by side.
+proxied = pytest.mark.parametrize(
+    "proxy_configuration",
+    [pytest.param(cfg, marks=pytest.mark.xdist_group(cfg)) for cfg in PROXY_CONFIGS],
+    indirect=True,
+)
+
 
 @dataclasses.dataclass
 class Proxy:
@@ -18,6 +41,7 @@ class Proxy:
     out_port: int
     encrypt_in: bool = False
     encrypt_out: bool = False
+    log_path: str = ""
 
 
 @dataclasses.dataclass
@@ -25,16 +49,73 @@ class HTTPServer:
     proc: subprocess.Popen
     addr: str
     port: int
+    log_path: str = ""
+
+
+def free_ports(n) -> list[int]:
+    """Allocate n distinct ephemeral ports.
+
+    All n sockets stay bound until every port has been read, so the kernel cannot hand the same
+    port out twice within one call.
+    """
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(n)]
+    try:
+        for s in socks:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(("127.0.0.1", 0))  # Bind to localhost on an ephemeral port
+        return [s.getsockname()[1] for s in socks]
+    finally:
+        for s in socks:
+            s.close()
+
+
+def _proc_net_addr(addr) -> str:
+    """addr in the hex form /proc/net/tcp{,6} prints: each 32-bit word in host byte order."""
+    packed = socket.inet_pton(socket.AF_INET6 if ":" in addr else socket.AF_INET, addr)
+    return "".join(
+        f"{int.from_bytes(packed[i : i + 4], sys.byteorder):08X}"
+        for i in range(0, len(packed), 4)
+    )
 
 
-def free_port():
-    """Fixture to provide a dynamically allocated free port."""
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(("127.0.0.1", 0))  # Bind to localhost on an ephemeral port
-    port = s.getsockname()[1]
-    s.close()
-    return port
+def is_listening(addr, port) -> bool:
+    """Check the kernel's TCP table for a socket in the LISTEN state on addr:port.
+
+    The address matters: the IPv4 and IPv6 HTTP servers share a port.
+    """
+    table = "/proc/net/tcp6" if ":" in addr else "/proc/net/tcp"
+    wanted = f"{_proc_net_addr(addr)}:{port:04X}"
+    with open(table, encoding="ascii") as f:
+        next(f)  # header
+        for line in f:
+            fields = line.split()
+            if "0A" == fields[3] and wanted == fields[1]:
+                return True
+    return False
+
+
+def log_tail(log_path, limit=16 * 1024) -> str:
+    """Last limit bytes of a log file, so sanitizer and valgrind reports end up in the failure."""
+    with open(log_path, "rb") as f:
+        f.seek(max(0, os.fstat(f.fileno()).st_size - limit))
+        return f.read().decode(errors="replace")
+
+
+def wait_listening(proc: subprocess.Popen, addr, port, log_path="", deadline=15.0):
+    """Poll until addr:port is listening, failing early if proc exits first.
+
+    Connecting to probe would be accepted by the proxy and forwarded upstream, so the kernel's
+    listen table is checked instead. Polling returns as soon as the port is up, so the deadline
+    only has to cover a slow start on a loaded machine.
+    """
+    end = time.monotonic() + deadline
+    while not is_listening(addr, port):
+        exited = proc.poll() is not None
+        if exited or time.monotonic() >= end:
+            status = f"Exited with {proc.returncode}" if exited else "Still running"
+            output = f" ({log_path}):\n{log_tail(log_path)}" if log_path else ""
+            assert False, f"{status}, nothing listening on {addr} port {port}{output}"
+        time.sleep(0.002)
 
 
 def wait_for_proxy_exit(proxies: list[Proxy]):
@@ -44,7 +125,9 @@ def wait_for_proxy_exit(proxies: list[Proxy]):
     for proxy in proxies:
         try:
             proxy.proc.wait(timeout=5)
-            assert 0 == proxy.proc.returncode
+            assert 0 == proxy.proc.returncode, (
+                f"Proxy failed ({proxy.log_path}):\n{log_tail(proxy.log_path)}"
+            )
         except subprocess.TimeoutExpired:
             proxy.proc.kill()
             proxy.proc.wait(timeout=5)
@@ -52,6 +135,7 @@ def wait_for_proxy_exit(proxies: list[Proxy]):
 
 
 def create_proxy(
+    log_dir,
     in_port,
     out_port,
     in_addr="127.0.0.1",
@@ -74,28 +158,52 @@ def create_proxy(
 
     proc_args_list += [in_addr, str(in_port), out_addr, str(out_port)]
 
+    # Each proxy logs to its own file rather than interleaving on pytest's stdout.
+    log_path = os.path.join(log_dir, f"proxy-{in_port}.log")
+    with open(log_path, "wb") as log:
+        proc = subprocess.Popen(
+            proc_args_list,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+        )
+
     proxy = Proxy(
-        proc=subprocess.Popen(proc_args_list),
+        proc=proc,
         in_addr=in_addr,
         in_port=in_port,
         out_addr=out_addr,
         out_port=out_port,
         encrypt_in=encrypt_in,
         encrypt_out=encrypt_out,
+        log_path=log_path,
     )
 
-    if "valgrind" in proc_args_list:
-        time.sleep(1)
-    else:
-        time.sleep(0.1)
+    wait_listening(
+        proc, in_addr, in_port, log_path, 60.0 if "valgrind" in proc_args_list else 15.0
+    )
 
     return proxy
 
 
-@pytest.fixture(scope="function")
-def single_proxy_unencrypted_fs():
-    port = free_port()
-    proxies = [create_proxy(port, 8000)]
+@pytest.fixture(scope="session")
+def log_dir_ss(tmp_path_factory):
+    """Directory for the proxy and HTTP server log files, cleaned up with pytest's other temp dirs."""
+    return tmp_path_factory.mktemp("logs")
+
+
+@pytest.fixture(scope="session")
+def upstream_port():
+    """Port the last proxy in every chain connects to. Allocated per xdist worker."""
+    (port,) = free_ports(1)
+    return port
+
+
+@pytest.fixture(scope="module")
+def single_proxy_unencrypted_ms(upstream_port, log_dir_ss):
+    (port,) = free_ports(1)
+    proxies = [create_proxy(log_dir_ss, port, upstream_port)]
 
     yield proxies
 
@@ -105,126 +213,235 @@ def single_proxy_unencrypted_fs():
 @pytest.fixture
 def proxy_configuration(request):
     # request.param is a fixture name; resolve it to the actual proxy chain object
-    return request.getfixturevalue(request.param)
+    proxies = request.getfixturevalue(request.param)
+    # Proxy chains are shared across a module, so catch one that died during an earlier test.
+    dead = [p for p in proxies if p.proc.poll() is not None]
+    assert not dead, "Proxy exited between tests:\n" + "\n".join(
+        f"{p.log_path}:\n{log_tail(p.log_path)}" for p in dead
+    )
+    return proxies
 
 
 @pytest.fixture(scope="function")
-def single_proxy_ipv6_fs():
-    port = free_port()
-    proxies = [create_proxy(port, 8000, in_addr="::1", out_addr="::1")]
+def single_proxy_ipv6_fs(upstream_port, log_dir_ss):
+    (port,) = free_ports(1)
+    proxies = [
+        create_proxy(log_dir_ss, port, upstream_port, in_addr="::1", out_addr="::1")
+    ]
 
     yield proxies
 
     wait_for_proxy_exit(proxies)
 
 
-@pytest.fixture(scope="function")
-def double_proxy_unencrypted_fs():
+@pytest.fixture(scope="module")
+def double_proxy_unencrypted_ms(upstream_port, log_dir_ss):
     proxies: list[Proxy] = []
-    port1, port2 = free_port(), free_port()
-    proxies.append(create_proxy(port1, port2))
-    proxies.append(create_proxy(port2, 8000))
+    port1, port2 = free_ports(2)
+    proxies.append(create_proxy(log_dir_ss, port1, port2))
+    proxies.append(create_proxy(log_dir_ss, port2, upstream_port))
 
     yield proxies
 
     wait_for_proxy_exit(proxies)
 
 
-@pytest.fixture(scope="function")
-def triple_proxy_unencrypted_fs():
+@pytest.fixture(scope="module")
+def triple_proxy_unencrypted_ms(upstream_port, log_dir_ss):
     proxies: list[Proxy] = []
-    port1, port2, port3 = (
-        free_port(),
-        free_port(),
-        free_port(),
-    )
+    port1, port2, port3 = free_ports(3)
 
-    proxies.append(create_proxy(port1, port2))
-    proxies.append(create_proxy(port2, port3))
-    proxies.append(create_proxy(port3, 8000))
+    proxies.append(create_proxy(log_dir_ss, port1, port2))
+    proxies.append(create_proxy(log_dir_ss, port2, port3))
+    proxies.append(create_proxy(log_dir_ss, port3, upstream_port))
 
     yield proxies
 
     wait_for_proxy_exit(proxies)
 
 
-@pytest.fixture(scope="function")
-def double_proxy_encrypted_fs():
+@pytest.fixture(scope="module")
+def double_proxy_encrypted_ms(upstream_port, log_dir_ss):
     proxies: list[Proxy] = []
-    port1, port2 = free_port(), free_port()
-    proxies.append(create_proxy(port1, port2, encrypt_out=True))
-    proxies.append(create_proxy(port2, 8000, encrypt_in=True))
+    port1, port2 = free_ports(2)
+    proxies.append(create_proxy(log_dir_ss, port1, port2, encrypt_out=True))
+    proxies.append(create_proxy(log_dir_ss, port2, upstream_port, encrypt_in=True))
 
     yield proxies
 
     wait_for_proxy_exit(proxies)
 
 
-@pytest.fixture(scope="function")
-def triple_proxy_encrypted_fs():
+@pytest.fixture(scope="module")
+def triple_proxy_encrypted_ms(upstream_port, log_dir_ss):
     proxies: list[Proxy] = []
-    port1, port2, port3 = (
-        free_port(),
-        free_port(),
-        free_port(),
-    )
+    port1, port2, port3 = free_ports(3)
 
-    proxies.append(create_proxy(port1, port2, encrypt_out=True))
-    proxies.append(create_proxy(port2, port3, encrypt_in=True, encrypt_out=True))
-    proxies.append(create_proxy(port3, 8000, encrypt_in=True))
+    proxies.append(create_proxy(log_dir_ss, port1, port2, encrypt_out=True))
+    proxies.append(
+        create_proxy(log_dir_ss, port2, port3, encrypt_in=True, encrypt_out=True)
+    )
+    proxies.append(create_proxy(log_dir_ss, port3, upstream_port, encrypt_in=True))
 
     yield proxies
 
     wait_for_proxy_exit(proxies)
 
 
-@pytest.fixture(scope="function")
-def quad_proxy_encrypted_fs():
+@pytest.fixture(scope="module")
+def quad_proxy_encrypted_ms(upstream_port, log_dir_ss):
     proxies: list[Proxy] = []
-    port1, port2, port3, port4 = (
-        free_port(),
-        free_port(),
-        free_port(),
-        free_port(),
-    )
+    port1, port2, port3, port4 = free_ports(4)
 
-    proxies.append(create_proxy(port1, port2, encrypt_out=True))
-    proxies.append(create_proxy(port2, port3, encrypt_in=True, encrypt_out=True))
-    proxies.append(create_proxy(port3, port4, encrypt_in=True, encrypt_out=True))
-    proxies.append(create_proxy(port4, 8000, encrypt_in=True))
+    proxies.append(create_proxy(log_dir_ss, port1, port2, encrypt_out=True))
+    proxies.append(
+        create_proxy(log_dir_ss, port2, port3, encrypt_in=True, encrypt_out=True)
+    )
+    proxies.append(
+        create_proxy(log_dir_ss, port3, port4, encrypt_in=True, encrypt_out=True)
+    )
+    proxies.append(create_proxy(log_dir_ss, port4, upstream_port, encrypt_in=True))
 
     yield proxies
 
     wait_for_proxy_exit(proxies)
 
 
-@pytest.fixture(scope="module")
-def python_http_server_ms():
-    run_path = ["python3", "-m", "http.server", "-d", "/tmp"]
+@pytest.fixture(scope="session")
+def docroot_ss(tmp_path_factory):
+    """Directory served by the HTTP servers.
 
-    server = HTTPServer(
-        proc=subprocess.Popen(run_path),
-        addr="127.0.0.1",
-        port=8000,
+    "/" is a fixed index.html so its bytes do not change as other fixtures write files.
+    """
+    root = tmp_path_factory.mktemp("docroot")
+    (root / "index.html").write_text(
+        "<!DOCTYPE html>\n<html><body>nacl-proxy test server</body></html>\n"
     )
-    time.sleep(0.2)
+    return root
+
+
+def _start_http_server(addr, port, docroot, log_dir, name):
+    """Serve docroot on addr:port with python's http.server, yielding it until the session ends.
+
+    Bind and startup errors go to a log that wait_listening includes in its failure.
+    """
+    log_path = os.path.join(log_dir, f"{name}-{port}.log")
+    run_path = [
+        "python3",
+        "-m",
+        "http.server",
+        str(port),
+        "-d",
+        str(docroot),
+        "--bind",
+        addr,
+    ]
+    with open(log_path, "wb") as log:
+        proc = subprocess.Popen(
+            run_path, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT
+        )
+
+    server = HTTPServer(proc=proc, addr=addr, port=port, log_path=log_path)
+    wait_listening(server.proc, server.addr, server.port, server.log_path)
     yield server
 
     server.proc.terminate()
     server.proc.wait(timeout=5)
 
 
-@pytest.fixture(scope="function")
-def python_http_server_ipv6_fs():
-    run_path = ["python3", "-m", "http.server", "-d", "/tmp", "--bind", "::1"]
+@pytest.fixture(scope="session")
+def python_http_server_ss(upstream_port, docroot_ss, log_dir_ss):
+    yield from _start_http_server(
+        "127.0.0.1", upstream_port, docroot_ss, log_dir_ss, "http-server"
+    )
 
-    server = HTTPServer(
-        proc=subprocess.Popen(run_path),
-        addr="::1",
-        port=8000,
+
+@pytest.fixture(scope="session")
+def python_http_server_ipv6_ss(upstream_port, docroot_ss, log_dir_ss):
+    yield from _start_http_server(
+        "::1", upstream_port, docroot_ss, log_dir_ss, "http-server-ipv6"
     )
-    time.sleep(0.2)
-    yield server
 
-    server.proc.terminate()
-    server.proc.wait(timeout=5)
+
+def _make_random_file(path, n):
+    """Fill path with n random bytes, piped from /dev/urandom by the kernel where sendfile allows it."""
+    try:
+        with open(path, "wb") as out, open("/dev/urandom", "rb") as rnd:
+            left = n
+            while left:
+                sent = os.sendfile(out.fileno(), rnd.fileno(), None, left)
+                assert sent > 0, "sendfile from /dev/urandom made no progress"
+                left -= sent
+    except OSError:
+        # Older kernels cannot splice from /dev/urandom.
+        path.write_bytes(os.urandom(n))
+
+
+def rand_bytes(n, arena):
+    """First n bytes of the random arena, copied out for APIs that need real bytes."""
+    assert n <= len(arena), f"{n} bytes requested from a {len(arena)} byte random arena"
+    return bytes(arena[:n])
+
+
+@pytest.fixture(scope="session")
+def rand_arena_ss():
+    """1 MiB of random data generated once; small payloads are slices of it rather than fresh urandom calls."""
+    return memoryview(os.urandom(1024 * 1024))
+
+
+@pytest.fixture(scope="session")
+def random_files_ss(docroot_ss):
+    """Random payload files for the HTTP servers to serve, written once per session.
+
+    Maps each name to (path, url_path), where url_path is the file's path under the docroot.
+    """
+    blobs = docroot_ss / "blobs"
+    blobs.mkdir()
+    sizes = {
+        "large_8m": ("large.bin", 8 * 1024 * 1024),
+        "payload_2m": ("payload.bin", 2 * 1024 * 1024),
+        "abort_4m": ("abort.bin", 4 * 1024 * 1024),
+    }
+    files = {}
+    for name, (filename, n) in sizes.items():
+        _make_random_file(blobs / filename, n)
+        files[name] = (blobs / filename, f"/blobs/{filename}")
+    return files
+
+
+@pytest.fixture(scope="session")
+def http_ss():
+    """requests.Session for the small whole-body comparisons and the abort test.
+
+    Reusing one session keeps a pooled connection per host between tests; the default pool size
+    covers the two concurrent fetches in test_ipv6.
+    """
+    session = requests.Session()
+    # Parity checks compare raw bodies, so there is no point asking for (and decoding) compression.
+    session.headers["Accept-Encoding"] = "identity"
+    # No retries: a retried request would hide a connection the proxy dropped.
+    session.mount("http://", HTTPAdapter(max_retries=0))
+    yield session
+    session.close()
+
+
+@pytest.fixture(scope="session")
+def random_file_factory_ss(tmp_path_factory, rand_arena_ss):
+    """Returns make(n), which writes n random bytes to a file once per size and returns its path."""
+    payloads = tmp_path_factory.mktemp("payloads")
+
+    @functools.cache
+    def make(n):
+        path = payloads / f"{n}.bin"
+        path.write_bytes(rand_bytes(n, rand_arena_ss))
+        return path
+
+    return make
+
+
+@pytest.fixture(scope="session")
+def thread_pool_ss():
+    """Worker threads shared by the concurrent client tests instead of a pool per test."""
+    ex = cf.ThreadPoolExecutor(max_workers=16)
+    yield ex
+    ex.shutdown(wait=True)
@@ -18,114 +18,152 @@ import pytest
 # pylint: disable=W0621,W0611
 
 from fixtures import (
+    proxied,
     Proxy,  # type: ignore
     proxy_configuration,
-    single_proxy_unencrypted_fs,
-    double_proxy_unencrypted_fs,
-    triple_proxy_unencrypted_fs,
-    double_proxy_encrypted_fs,
-    triple_proxy_encrypted_fs,
-    quad_proxy_encrypted_fs,
+    log_dir_ss,
+    single_proxy_unencrypted_ms,
+    double_proxy_unencrypted_ms,
+    triple_proxy_unencrypted_ms,
+    double_proxy_encrypted_ms,
+    triple_proxy_encrypted_ms,
+    quad_proxy_encrypted_ms,
+    random_file_factory_ss,
+    rand_arena_ss,
+    rand_bytes,
 )
 
 
-UPSTREAM_ADDR = ("127.0.0.1", 8000)
 SMALL_TIMEOUT = 3
 LARGE_TIMEOUT = 10
+SOCK_BUF = 1 << 20
+
+# Intermediate sizes exercise the same forwarding path; set FULL_MATRIX=1 to run them all.
+FULL_MATRIX = bool(os.environ.get("FULL_MATRIX"))
+ROUNDTRIP_SIZES = [1, 64, 1500, 65536] if FULL_MATRIX else [64, 65536]
+PUSH_SIZES = [3, 4096, 20000] if FULL_MATRIX else [3, 20000]
+
+
+@pytest.fixture(scope="module")
+def upstream_listener_ms():
+    """Upstream listener shared by every test in the module; each test accepts one connection."""
+    listen = socket.create_server(("127.0.0.1", 0), backlog=64)
+    listen.settimeout(SMALL_TIMEOUT)
+    yield listen
+    listen.close()
+
+
+@pytest.fixture(scope="module")
+def upstream_port(upstream_listener_ms):
+    """Overrides the session upstream port, which the session HTTP server keeps bound."""
+    return upstream_listener_ms.getsockname()[1]
 
 
 def _recv_exact(sock, n):
     buf = bytearray(n)
     view = memoryview(buf)
+    # MSG_WAITALL lets the kernel fill the buffer in one call where it can. Sockets with a timeout
+    # are non-blocking underneath, so short reads are still possible and the loop stays.
+    flags = getattr(socket, "MSG_WAITALL", 0)
     got = 0
     while got < n:
-        r = sock.recv_into(view[got:], n - got)
+        r = sock.recv_into(view[got:], n - got, flags)
         assert r > 0, "peer closed early"
         got += r
-    return bytes(buf)
-
-
-def _connect_through_proxy(proxy):
-    # Upstream listener on fixed port
-    listen = socket.create_server(UPSTREAM_ADDR, backlog=16)
-    listen.settimeout(SMALL_TIMEOUT)
-
-    # Client connects to proxy entrypoint; proxy will connect upstream
+    return buf
+
+
+def _tune(*socks):
+    # Small ping-pong writes across several hops otherwise stall on Nagle + delayed ACK, and
+    # 1 MiB buffers let the larger payloads sit in the kernel instead of trickling through.
+    for sock in socks:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF)
+
+
+def _drain(listener):
+    # The listener outlives each test, so close any upstream connection left queued by an earlier
+    # test that timed out; otherwise the next accept would pair this test's client with it.
+    listener.setblocking(False)
+    try:
+        while True:
+            try:
+                stale, _ = listener.accept()
+            except BlockingIOError:
+                break
+            stale.close()
+    finally:
+        listener.settimeout(SMALL_TIMEOUT)
+
+
+def _connect_through_proxy(proxy, listener):
+    _drain(listener)
+    # Client connects to proxy entrypoint; proxy will connect upstream to the listener
     c = socket.create_connection((proxy.in_addr, proxy.in_port), timeout=SMALL_TIMEOUT)
-    s, _ = listen.accept()
-    listen.close()
+    s, _ = listener.accept()
 
     c.settimeout(LARGE_TIMEOUT)
     s.settimeout(LARGE_TIMEOUT)
+    _tune(c, s)
     return c, s
 
 
-@pytest.mark.parametrize(
-    "proxy_configuration",
-    [
-        "single_proxy_unencrypted_fs",
-        "double_proxy_unencrypted_fs",
-        "triple_proxy_unencrypted_fs",
-        "double_proxy_encrypted_fs",
-        "triple_proxy_encrypted_fs",
-        "quad_proxy_encrypted_fs",
-    ],
-    indirect=True,
-)
-def test_server_sends_first_banner_basic(proxy_configuration):
+@proxied
+def test_server_sends_first_banner_basic(proxy_configuration, upstream_listener_ms):
     """
     Test that the server can send data first and the client receives it through the proxy.
     Also verifies bidirectional communication through the proxy.
     """
     proxy = proxy_configuration[0]
 
-    with closing(socket.create_server(UPSTREAM_ADDR, backlog=16)) as listen:
-        listen.settimeout(SMALL_TIMEOUT)
-        with closing(
-            socket.create_connection(
-                (proxy.in_addr, proxy.in_port), timeout=SMALL_TIMEOUT
-            )
-        ) as client:
-            server, _ = listen.accept()
-            with closing(server):
-                client.settimeout(LARGE_TIMEOUT)
-                server.settimeout(LARGE_TIMEOUT)
-
-                # Server sends first
-                banner = b"Hello, client!\n"
-                server.sendall(banner)
-                assert _recv_exact(client, len(banner)) == banner
-
-                # Minimal bi-dir proof
-                payload = b"PING"
-                client.sendall(payload)
-                assert _recv_exact(server, len(payload)) == payload
-                server.sendall(payload)
-                assert _recv_exact(client, len(payload)) == payload
-
-
-@pytest.mark.parametrize(
-    "proxy_configuration",
-    [
-        "single_proxy_unencrypted_fs",
-        "double_proxy_unencrypted_fs",
-        "triple_proxy_unencrypted_fs",
-        "double_proxy_encrypted_fs",
-        "triple_proxy_encrypted_fs",
-        "quad_proxy_encrypted_fs",
-    ],
-    indirect=True,
-)
-@pytest.mark.parametrize("n", [1, 64, 1500, 65536])
-def test_client_to_server_roundtrip_sizes(proxy_configuration, n):
+    _drain(upstream_listener_ms)
+    with closing(
+        socket.create_connection((proxy.in_addr, proxy.in_port), timeout=SMALL_TIMEOUT)
+    ) as client:
+        server, _ = upstream_listener_ms.accept()
+        with closing(server):
+            client.settimeout(LARGE_TIMEOUT)
+            server.settimeout(LARGE_TIMEOUT)
+            _tune(client, server)
+
+            # Server sends first
+            banner = b"Hello, client!\n"
+            server.sendall(banner)
+            assert _recv_exact(client, len(banner)) == banner
+
+            # Minimal bi-dir proof
+            payload = b"PING"
+            client.sendall(payload)
+            assert _recv_exact(server, len(payload)) == payload
+            server.sendall(payload)
+            assert _recv_exact(client, len(payload)) == payload
+
+
+@pytest.fixture(scope="session", params=ROUNDTRIP_SIZES)
+def roundtrip_blob_ss(request, rand_arena_ss):
+    """(size, random payload) pairs, generated once per size for every proxy configuration."""
+    return request.param, rand_bytes(request.param, rand_arena_ss)
+
+
+@pytest.fixture(scope="session", params=PUSH_SIZES)
+def push_file_ss(request, random_file_factory_ss):
+    """(size, random payload file) pairs, so the server side can push with sendfile."""
+    return request.param, random_file_factory_ss(request.param)
+
+
+@proxied
+def test_client_to_server_roundtrip_sizes(
+    proxy_configuration, upstream_listener_ms, roundtrip_blob_ss
+):
     """
     Test roundtrip data integrity for various payload sizes sent from client to server and echoed back.
-    Ensures the proxy correctly forwards data of different sizes.
+    Ensures the proxy correctly forwards data of different sizes (all of them with FULL_MATRIX=1).
     """
     proxy = proxy_configuration[0]
-    client, server = _connect_through_proxy(proxy)
+    client, server = _connect_through_proxy(proxy, upstream_listener_ms)
+    n, blob = roundtrip_blob_ss
     with closing(client), closing(server):
-        blob = os.urandom(n)
         client.sendall(blob)
         # server reads then echoes
         got = _recv_exact(server, n)
@@ -135,28 +173,16 @@ def test_client_to_server_roundtrip_sizes(proxy_configuration, n):
         assert back == blob
 
 
-@pytest.mark.parametrize(
-    "proxy_configuration",
-    [
-        "single_proxy_unencrypted_fs",
-        "double_proxy_unencrypted_fs",
-        "triple_proxy_unencrypted_fs",
-        "double_proxy_encrypted_fs",
-        "triple_proxy_encrypted_fs",
-        "quad_proxy_encrypted_fs",
-    ],
-    indirect=True,
-)
-@pytest.mark.parametrize("n", [3, 4096, 20000])
-def test_server_push_sizes(proxy_configuration, n):
+@proxied
+def test_server_push_sizes(proxy_configuration, upstream_listener_ms, push_file_ss):
     """
     Test that the server can push data of various sizes to the client through the proxy.
-    Verifies that the proxy correctly forwards server-to-client data.
+    Verifies that the proxy correctly forwards server-to-client data (all sizes with FULL_MATRIX=1).
     """
     proxy = proxy_configuration[0]
-    client, server = _connect_through_proxy(proxy)
-    with closing(client), closing(server):
-        blob = os.urandom(n)
-        server.sendall(blob)
+    client, server = _connect_through_proxy(proxy, upstream_listener_ms)
+    n, path = push_file_ss
+    with closing(client), closing(server), open(path, "rb") as f:
+        server.sendfile(f)
         got = _recv_exact(client, n)
-        assert got == blob
+        assert got == path.read_bytes()
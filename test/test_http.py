@@ -7,169 +7,146 @@ transfers are reliable, concurrent clients are handled properly, aborted connect
 subsequent requests, hostname resolution works as expected, and IPv6 traffic is supported.
 """
 
-import concurrent.futures as cf
+import functools
 import hashlib
+import http.client
 import os
-from pathlib import Path
 
 import pytest
-import requests
 
 # pylint: disable=W0621,W0611
 
 from fixtures import (
+    proxied,
     HTTPServer,
     Proxy,  # type: ignore
     proxy_configuration,
-    python_http_server_ms,
+    log_dir_ss,
+    python_http_server_ss,
+    docroot_ss,
     single_proxy_ipv6_fs,
-    single_proxy_unencrypted_fs,
-    double_proxy_unencrypted_fs,
-    triple_proxy_unencrypted_fs,
-    double_proxy_encrypted_fs,
-    triple_proxy_encrypted_fs,
-    quad_proxy_encrypted_fs,
-    python_http_server_ipv6_fs,
+    single_proxy_unencrypted_ms,
+    double_proxy_unencrypted_ms,
+    triple_proxy_unencrypted_ms,
+    double_proxy_encrypted_ms,
+    triple_proxy_encrypted_ms,
+    quad_proxy_encrypted_ms,
+    python_http_server_ipv6_ss,
+    random_files_ss,
+    upstream_port,
+    http_ss,
+    thread_pool_ss,
 )
 
-DOCROOT = Path("/tmp")
 SMALL_TIMEOUT = 3
 LARGE_TIMEOUT = 10
+HASH_CHUNK = 1024 * 1024
 
 
-@pytest.mark.parametrize(
-    "proxy_configuration",
-    [
-        "single_proxy_unencrypted_fs",
-        "double_proxy_unencrypted_fs",
-        "triple_proxy_unencrypted_fs",
-        "double_proxy_encrypted_fs",
-        "triple_proxy_encrypted_fs",
-        "quad_proxy_encrypted_fs",
-    ],
-    indirect=True,
-)
-def test_root_bytes_match(proxy_configuration, python_http_server_ms):
+def _sha256_stream(host: str, port: int, path: str) -> str:
+    # Only the body bytes matter here, so skip the requests layer and hash the raw response.
+    h = hashlib.sha256()
+    conn = http.client.HTTPConnection(host, port, timeout=LARGE_TIMEOUT)
+    try:
+        conn.request("GET", path)
+        r = conn.getresponse()
+        assert r.status // 100 == 2, f"GET {path} returned {r.status}"
+        while chunk := r.read1(HASH_CHUNK):
+            h.update(chunk)
+    finally:
+        conn.close()
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=256)
+def _sha256_file_cached(path: str, mtime_ns: int) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _sha256_file(path) -> str:
+    # The reference digest comes from the file the server serves, hashed entirely in C. Keyed on
+    # mtime as well, so each file is hashed once per session unless it is rewritten.
+    return _sha256_file_cached(str(path), os.stat(path).st_mtime_ns)
+
+
+def _both(pool, session, direct_url: str, proxy_url: str, **kw):
+    # The direct and proxied requests are independent, so issue them concurrently.
+    fd = pool.submit(session.get, direct_url, **kw)
+    fp = pool.submit(session.get, proxy_url, **kw)
+    return fd.result(), fp.result()
+
+
+@pytest.fixture(scope="session")
+def direct_root_bytes_ss(python_http_server_ss, http_ss):
+    """Body of '/' fetched straight from the server, which is the same for every proxy chain."""
+    server: HTTPServer = python_http_server_ss
+    r = http_ss.get(f"http://{server.addr}:{server.port}", timeout=SMALL_TIMEOUT)
+    r.raise_for_status()
+    return r.content
+
+
+@proxied
+def test_root_bytes_match(proxy_configuration, direct_root_bytes_ss, http_ss):
     """
     Test that fetching '/' directly from the server and through the proxy yields identical content.
     Ensures the proxy does not alter HTTP payloads.
     """
     proxy: Proxy = proxy_configuration[0]
-    server: HTTPServer = python_http_server_ms
 
-    direct = requests.get(f"http://{server.addr}:{server.port}", timeout=SMALL_TIMEOUT)
-    via = requests.get(f"http://{proxy.in_addr}:{proxy.in_port}", timeout=SMALL_TIMEOUT)
+    via = http_ss.get(f"http://{proxy.in_addr}:{proxy.in_port}", timeout=SMALL_TIMEOUT)
 
-    assert direct.status_code // 100 == 2
     assert via.status_code // 100 == 2
-    assert direct.content == via.content
+    assert direct_root_bytes_ss == via.content
 
 
-@pytest.mark.parametrize(
-    "proxy_configuration",
-    [
-        "single_proxy_unencrypted_fs",
-        "double_proxy_unencrypted_fs",
-        "triple_proxy_unencrypted_fs",
-        "double_proxy_encrypted_fs",
-        "triple_proxy_encrypted_fs",
-        "quad_proxy_encrypted_fs",
-    ],
-    indirect=True,
-)
-def test_large_transfer_integrity(proxy_configuration, python_http_server_ms, tmp_path):
+@proxied
+def test_large_transfer_integrity(
+    proxy_configuration, python_http_server_ss, random_files_ss
+):
     """
     Test integrity of large file transfers through the proxy.
-    Compares SHA256 hashes of direct and proxied downloads to ensure no corruption.
+    Compares the SHA256 of the proxied download with that of the served file to ensure no corruption.
     """
     proxy: Proxy = proxy_configuration[0]
-    server: HTTPServer = python_http_server_ms
-
-    # Make a large file under /tmp for the HTTP file server to serve.
-    big = tmp_path / "large.bin"
-    with big.open("wb") as f:
-        remaining = 8 * 1024 * 1024
-        block = os.urandom(8192)
-        while remaining > 0:
-            n = min(remaining, len(block))
-            f.write(block[:n])
-            remaining -= n
-
-    rel = "/" + str(big.relative_to(DOCROOT)).replace("\\", "/")
-
-    def sha256_stream(url: str) -> str:
-        h = hashlib.sha256()
-        with requests.get(url, stream=True, timeout=LARGE_TIMEOUT) as r:
-            r.raise_for_status()
-            for chunk in r.iter_content(64 * 1024):
-                if chunk:
-                    h.update(chunk)
-        return h.hexdigest()
-
-    d = sha256_stream(f"http://{server.addr}:{server.port}{rel}")
-    p = sha256_stream(f"http://{proxy.in_addr}:{proxy.in_port}{rel}")
+
+    # Large file under the docroot for the HTTP file server to serve.
+    big, rel = random_files_ss["large_8m"]
+
+    d = _sha256_file(big)
+    p = _sha256_stream(proxy.in_addr, proxy.in_port, rel)
     assert d == p
 
 
-@pytest.mark.parametrize(
-    "proxy_configuration",
-    [
-        "single_proxy_unencrypted_fs",
-        "double_proxy_unencrypted_fs",
-        "triple_proxy_unencrypted_fs",
-        "double_proxy_encrypted_fs",
-        "triple_proxy_encrypted_fs",
-        "quad_proxy_encrypted_fs",
-    ],
-    indirect=True,
-)
-def test_concurrent_clients(proxy_configuration, python_http_server_ms, tmp_path):
+@proxied
+def test_concurrent_clients(
+    proxy_configuration, python_http_server_ss, random_files_ss, thread_pool_ss
+):
     """
     Test concurrent client downloads through the proxy.
     Ensures all clients receive identical data and the proxy handles concurrency correctly.
     """
     proxy: Proxy = proxy_configuration[0]
-    server: HTTPServer = python_http_server_ms
-
-    payload = tmp_path / "payload.bin"
-    payload.write_bytes(os.urandom(2 * 1024 * 1024))
-    rel = "/" + str(payload.relative_to(DOCROOT)).replace("\\", "/")
 
-    direct_url = f"http://{server.addr}:{server.port}{rel}"
-    proxy_url = f"http://{proxy.in_addr}:{proxy.in_port}{rel}"
+    payload, rel = random_files_ss["payload_2m"]
 
-    ref = hashlib.sha256(
-        requests.get(direct_url, timeout=LARGE_TIMEOUT).content
-    ).hexdigest()
+    ref = _sha256_file(payload)
 
     def fetch_hash():
-        return hashlib.sha256(
-            requests.get(proxy_url, timeout=LARGE_TIMEOUT).content
-        ).hexdigest()
+        return _sha256_stream(proxy.in_addr, proxy.in_port, rel)
 
-    num_threads = 12
-    with cf.ThreadPoolExecutor(max_workers=num_threads) as ex:
-        results = list(ex.map(lambda _: fetch_hash(), range(num_threads)))
+    num_clients = 12
+    results = list(thread_pool_ss.map(lambda _: fetch_hash(), range(num_clients)))
 
     assert all(h == ref for h in results)
 
 
-@pytest.mark.parametrize(
-    "proxy_configuration",
-    [
-        "single_proxy_unencrypted_fs",
-        "double_proxy_unencrypted_fs",
-        "triple_proxy_unencrypted_fs",
-        "double_proxy_encrypted_fs",
-        "triple_proxy_encrypted_fs",
-        "quad_proxy_encrypted_fs",
-    ],
-    indirect=True,
-)
+@proxied
 def test_client_abort_then_next_ok(
     proxy_configuration,
-    python_http_server_ms,
-    tmp_path,  # pylint: disable=W0613
+    python_http_server_ss,  # pylint: disable=W0613
+    random_files_ss,
+    http_ss,
 ):
     """
     Test that aborting a client download does not affect subsequent downloads through the proxy.
@@ -177,55 +154,42 @@ def test_client_abort_then_next_ok(
     """
     proxy: Proxy = proxy_configuration[0]
 
-    big = tmp_path / "abort.bin"
-    big.write_bytes(os.urandom(4 * 1024 * 1024))
-    rel = "/" + str(big.relative_to(DOCROOT)).replace("\\", "/")
-
+    _, rel = random_files_ss["abort_4m"]
     url = f"http://{proxy.in_addr}:{proxy.in_port}{rel}"
-    r = requests.get(url, stream=True, timeout=LARGE_TIMEOUT)
+    r = http_ss.get(url, stream=True, timeout=LARGE_TIMEOUT)
     next(r.iter_content(64 * 1024))
     r.close()
 
-    h1 = hashlib.sha256(requests.get(url, timeout=LARGE_TIMEOUT).content).hexdigest()
-    h2 = hashlib.sha256(requests.get(url, timeout=LARGE_TIMEOUT).content).hexdigest()
+    h1 = _sha256_stream(proxy.in_addr, proxy.in_port, rel)
+    h2 = _sha256_stream(proxy.in_addr, proxy.in_port, rel)
     assert h1 == h2
 
 
-@pytest.mark.parametrize(
-    "proxy_configuration",
-    [
-        "single_proxy_unencrypted_fs",
-        "double_proxy_unencrypted_fs",
-        "triple_proxy_unencrypted_fs",
-        "double_proxy_encrypted_fs",
-        "triple_proxy_encrypted_fs",
-        "quad_proxy_encrypted_fs",
-    ],
-    indirect=True,
-)
-def test_hostname_resolution_to_proxy(proxy_configuration, python_http_server_ms):
+@proxied
+def test_hostname_resolution_to_proxy(
+    proxy_configuration, direct_root_bytes_ss, http_ss
+):
     """
     Test that the proxy correctly handles hostname resolution for incoming connections.
     Verifies that requests to 'localhost' are properly forwarded.
     """
     proxy: Proxy = proxy_configuration[0]
-    server: HTTPServer = python_http_server_ms
 
-    direct = requests.get(f"http://{server.addr}:{server.port}", timeout=SMALL_TIMEOUT)
-    via = requests.get(f"http://localhost:{proxy.in_port}", timeout=SMALL_TIMEOUT)
+    via = http_ss.get(f"http://localhost:{proxy.in_port}", timeout=SMALL_TIMEOUT)
 
-    assert direct.status_code // 100 == 2
     assert via.status_code // 100 == 2
-    assert direct.content == via.content
+    assert direct_root_bytes_ss == via.content
 
 
-def test_ipv6(single_proxy_ipv6_fs, python_http_server_ipv6_fs):
+def test_ipv6(
+    single_proxy_ipv6_fs, python_http_server_ipv6_ss, http_ss, thread_pool_ss
+):
     """
     Test proxying HTTP traffic over IPv6.
     Ensures the proxy can forward requests and responses using IPv6 addresses.
     """
     proxy: Proxy = single_proxy_ipv6_fs[0]
-    server: HTTPServer = python_http_server_ipv6_fs
+    server: HTTPServer = python_http_server_ipv6_ss
 
     bin_path = os.getenv("BIN_PATH")
 
@@ -233,10 +197,12 @@ def test_ipv6(single_proxy_ipv6_fs, python_http_server_ipv6_fs):
         pytest.skip("Skipping IPv6 test on glibc builds due to CI limitations.")
 
     url_v6 = f"http://[::1]:{proxy.in_port}"
-    via = requests.get(url_v6, timeout=SMALL_TIMEOUT)
-
-    direct = requests.get(
-        f"http://[{server.addr}]:{server.port}", timeout=SMALL_TIMEOUT
+    direct, via = _both(
+        thread_pool_ss,
+        http_ss,
+        f"http://[{server.addr}]:{server.port}",
+        url_v6,
+        timeout=SMALL_TIMEOUT,
     )
     assert direct.status_code // 100 == 2
     assert via.status_code // 100 == 2